@@ -3,149 +3,586 @@
 NimbusCode - A lightweight, portable AI coding assistant powered by OpenRouter's free models.
 """
 
-import argparse
+from __future__ import annotations
+
+import atexit
+import functools
+import hashlib
 import json
 import os
 import sys
-import configparser
-import textwrap
+import threading
+import time
+from collections.abc import Iterator
 from pathlib import Path
-import requests
-from typing import Optional, Dict, Any, List
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import requests
 
 CONFIG_DIR = Path.home() / ".config" / "nimbuscode"
-CONFIG_FILE = CONFIG_DIR / "config.ini"
+CONFIG_FILE = CONFIG_DIR / "config.toml"
+LEGACY_CONFIG_FILE = CONFIG_DIR / "config.ini"
+CACHE_DIR = CONFIG_DIR / "cache"
 DEFAULT_MODEL = "mistralai/mistral-7b-instruct:free"
+RACE_MODELS = [
+    DEFAULT_MODEL,
+    "google/gemma-7b-it:free",
+    "huggingfaceh4/zephyr-7b-beta:free",
+]
+DEFAULT_CACHE_TTL = 86400  # seconds
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
+MODELS_URL = "https://openrouter.ai/api/v1/models"
+MODELS_CACHE_FILE = CONFIG_DIR / "models.json"
+MODELS_ETAG_FILE = CONFIG_DIR / "models.etag"
+MAX_CONCURRENT_REQUESTS = 8
+DEFAULT_REQUESTS_PER_MINUTE = 20
+DEFAULT_HISTORY_TURNS = 8
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = (5, 60)  # (connect, read) seconds
+STREAM_TIMEOUT = (5, None)  # streamed reads stay open while tokens arrive
+GZIP_THRESHOLD = 1024  # bytes
+MMAP_THRESHOLD = 1024 * 1024  # bytes
+RESPONSE_TOKEN_MARGIN = 512  # tokens kept free for the completion
+
+@functools.lru_cache(maxsize=1)
+def _json_codec():
+    """Return (dumps, loads) callables, preferring orjson when installed."""
+    try:
+        import orjson
+        return orjson.dumps, orjson.loads
+    except ImportError:
+        return (lambda obj: json.dumps(obj).encode("utf-8")), json.loads
+
+def _json_dumps(obj) -> bytes:
+    return _json_codec()[0](obj)
+
+def _json_loads(data):
+    return _json_codec()[1](data)
+
+@functools.lru_cache(maxsize=1)
+def _parse_config(mtime_ns: int) -> dict[str, Any]:
+    """Parse the on-disk configuration; keyed by mtime so edits are noticed."""
+    if CONFIG_FILE.exists():
+        import tomllib
+        return tomllib.loads(CONFIG_FILE.read_text())
+    if LEGACY_CONFIG_FILE.exists():
+        # Migrate settings written by versions that used config.ini.
+        import configparser
+        legacy = configparser.ConfigParser()
+        legacy.read(LEGACY_CONFIG_FILE)
+        if "API" in legacy:
+            return dict(legacy["API"])
+    return {}
+
+def _load_config_cached() -> dict[str, Any]:
+    """Load the configuration, reparsing only when the file has changed."""
+    try:
+        mtime_ns = CONFIG_FILE.stat().st_mtime_ns
+    except OSError:
+        mtime_ns = -1
+    return _parse_config(mtime_ns)
+
+_load_config_cached.cache_clear = _parse_config.cache_clear
+
+_config_dir_ready = False
+_cache_dir_ready = False
+
+def _ensure_config_dir() -> None:
+    """Create the config directory, skipping the mkdir after the first call."""
+    global _config_dir_ready
+    if not _config_dir_ready:
+        CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        _config_dir_ready = True
+
+def _ensure_cache_dir() -> None:
+    """Create the response cache directory, skipping the mkdir after the first call."""
+    global _cache_dir_ready
+    if not _cache_dir_ready:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _cache_dir_ready = True
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    """Return a tiktoken encoder when available, else None."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except ImportError:
+        return None
+
+def _estimate_tokens(messages: list[dict[str, str]]) -> int:
+    """Estimate the prompt token count for a messages list.
+
+    Uses tiktoken when installed; otherwise falls back to the usual
+    four-characters-per-token heuristic.
+    """
+    encoder = _get_encoder()
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        if encoder:
+            total += len(encoder.encode(content))
+        else:
+            total += len(content) // 4 + 1
+    return total
+
+def _read_source(path: str) -> str:
+    """Read a source file, memory-mapping large ones to avoid an extra copy."""
+    if os.path.getsize(path) < MMAP_THRESHOLD:
+        # One buffered binary read, decoded explicitly so a stray non-UTF-8
+        # byte in a source file degrades to U+FFFD instead of aborting.
+        return Path(path).read_bytes().decode("utf-8", "replace")
+    import mmap
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            return mm[:].decode("utf-8", "replace")
+    finally:
+        os.close(fd)
+
+@functools.lru_cache(maxsize=1)
+def _code_block_re():
+    """Compile the fenced-code-block pattern on first use."""
+    import re
+    return re.compile(r"```[^\n]*\n(.*?)(?:```|\Z)", re.DOTALL)
+
+@functools.lru_cache(maxsize=1)
+def _closed_code_block_re():
+    """Compile the strict pattern that only matches fully closed blocks."""
+    import re
+    return re.compile(r"```[^\n]*\n(.*?)```", re.DOTALL)
+
+def extract_code_blocks(markdown_text: str) -> list[str]:
+    """Extract the contents of fenced code blocks from markdown text."""
+    return [block.rstrip() for block in _code_block_re().findall(markdown_text)]
+
+def iter_code_blocks(chunks) -> Iterator[str]:
+    """Yield fenced code blocks from a stream of text chunks as they close.
+
+    Closed blocks are sliced off the buffer once emitted, so only the
+    unconsumed tail is ever rescanned. An unterminated trailing block is
+    flushed when the stream ends, matching extract_code_blocks.
+    """
+    pattern = _closed_code_block_re()
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if "`" not in chunk:
+            continue
+        consumed = 0
+        for match in pattern.finditer(buffer):
+            yield match.group(1).rstrip()
+            consumed = match.end()
+        if consumed:
+            buffer = buffer[consumed:]
+    for block in extract_code_blocks(buffer):
+        yield block
+
+def _write_code_blocks(blocks: list[str]) -> list[str]:
+    """Write code blocks to numbered files, in parallel since writes are I/O-bound."""
+    if not blocks:
+        return []
+    from concurrent.futures import ThreadPoolExecutor
+    paths = [Path(f"code_block_{i + 1}.txt") for i in range(len(blocks))]
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(blocks))) as executor:
+        list(executor.map(
+            lambda pair: pair[0].write_bytes(pair[1].encode("utf-8") + b"\n"),
+            zip(paths, blocks),
+        ))
+    return [str(path) for path in paths]
+
+def _is_free_model(model: dict[str, Any]) -> bool:
+    """Return True if a catalog entry prices both prompt and completion at zero.
+
+    OpenRouter serialises prices as strings ("0"), so compare numerically.
+    """
+    pricing = model.get("pricing") or {}
+    try:
+        return (float(pricing.get("prompt", 1)) == 0.0
+                and float(pricing.get("completion", 1)) == 0.0)
+    except (TypeError, ValueError):
+        return False
+
+def _cacheable(content: str) -> list[dict[str, Any]]:
+    """Wrap message content with a prompt-cache breakpoint for providers that support it."""
+    return [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+
+_SYS_ASK = {"role": "system", "content": _cacheable("You are a helpful coding assistant. Provide concise, accurate answers to coding questions.")}
+_SYS_GENERATE = {"role": "system", "content": _cacheable("You are a code generator. Create clean, efficient, and well-documented code based on descriptions.")}
+_SYS_IMPROVE = {"role": "system", "content": _cacheable("You are a code reviewer. Suggest improvements to make the code more efficient, readable, and maintainable.")}
+_SYS_EXPLAIN = {"role": "system", "content": _cacheable("You are a code explainer. Break down complex code into understandable explanations.")}
+_SYS_CLOUD = {"role": "system", "content": _cacheable("You are a cloud deployment expert. Provide clear instructions for deploying applications to cloud platforms.")}
+_SYS_MOBILE = {"role": "system", "content": _cacheable("You are a mobile development expert. Provide guidance for building mobile applications.")}
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace requests to OpenRouter."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def sync(self, remaining: int) -> None:
+        """Clamp available tokens to what the server reports as remaining."""
+        with self.lock:
+            self.tokens = min(self.tokens, float(remaining))
 
 class NimbusCode:
     def __init__(self):
-        self.config = self._load_config()
+        self.config = _load_config_cached()
         self.api_key = self._get_api_key()
-        
-    def _load_config(self) -> configparser.ConfigParser:
-        """Load configuration from config file."""
-        config = configparser.ConfigParser()
-        if CONFIG_FILE.exists():
-            config.read(CONFIG_FILE)
-        if "DEFAULT" not in config:
-            config["DEFAULT"] = {}
-        if "API" not in config:
-            config["API"] = {}
-        return config
-    
+        self.use_cache = True
+        self._evict_stale_cache()
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        atexit.register(self.session.close)
+        rpm = float(self.config.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE))
+        self._bucket = TokenBucket(rpm / 60.0, MAX_CONCURRENT_REQUESTS)
+        self._base_headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip",
+            "HTTP-Referer": "https://github.com/naelmohammad/nimbuscode",
+            "X-Title": "NimbusCode"
+        }
+
     def _save_config(self) -> None:
         """Save configuration to config file."""
-        CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-        with open(CONFIG_FILE, "w") as f:
-            self.config.write(f)
-    
-    def _get_api_key(self) -> Optional[str]:
+        _ensure_config_dir()
+        lines = []
+        for key, value in self.config.items():
+            if isinstance(value, bool):
+                lines.append(f'{key} = {str(value).lower()}\n')
+            elif isinstance(value, str):
+                # JSON string escaping is valid inside a TOML basic string,
+                # so quotes and backslashes in values survive a reload.
+                lines.append(f'{key} = {json.dumps(value)}\n')
+            else:
+                lines.append(f'{key} = {value}\n')
+        # Write the whole file in one shot to a sibling and rename it into
+        # place, so a crash mid-save never leaves a truncated config behind.
+        tmp_file = CONFIG_FILE.with_suffix(".toml.tmp")
+        tmp_file.write_bytes("".join(lines).encode("utf-8"))
+        os.replace(tmp_file, CONFIG_FILE)
+        _load_config_cached.cache_clear()
+    
+    def _get_api_key(self) -> str | None:
         """Get API key from environment variable or config file."""
         api_key = os.environ.get("OPENROUTER_API_KEY")
-        if not api_key and "api_key" in self.config["API"]:
-            api_key = self.config["API"]["api_key"]
+        if not api_key:
+            api_key = self.config.get("api_key")
         return api_key
     
     def set_api_key(self, api_key: str) -> None:
         """Set API key in config file."""
-        self.config["API"]["api_key"] = api_key
+        self.config["api_key"] = api_key
         self._save_config()
         self.api_key = api_key
+        self._base_headers["Authorization"] = f"Bearer {api_key}"
         print("API key saved successfully.")
     
-    def _make_request(self, messages: List[Dict[str, str]], model: str = None) -> Dict[str, Any]:
+    def _request_data(self, messages: list[dict[str, str]], model: str, stream: bool = False) -> dict[str, Any]:
+        """Build the POST payload for a chat completion."""
+        data = {
+            "model": model,
+            "messages": messages
+        }
+        if stream:
+            data["stream"] = True
+        if model.startswith("anthropic/"):
+            data["cache_control"] = {"type": "ephemeral"}
+        return data
+
+    def _post(self, data: dict[str, Any], stream: bool = False) -> requests.Response:
+        """POST to the API through the rate limiter, backing off on 429."""
+        body = _json_dumps(data)
+        headers = self._base_headers
+        if len(body) > GZIP_THRESHOLD:
+            import gzip
+            body = gzip.compress(body, 1)
+            headers = {**self._base_headers, "Content-Encoding": "gzip"}
+        for attempt in range(MAX_RETRIES):
+            self._bucket.acquire()
+            response = self.session.post(API_URL, headers=headers, data=body, stream=stream,
+                                         timeout=STREAM_TIMEOUT if stream else REQUEST_TIMEOUT)
+            if response.status_code == 429 and attempt < MAX_RETRIES - 1:
+                # Retry-After may be seconds or an HTTP-date (RFC 9110).
+                retry_after = float(2 ** attempt)
+                header = response.headers.get("Retry-After")
+                if header:
+                    try:
+                        retry_after = float(header)
+                    except ValueError:
+                        from email.utils import parsedate_to_datetime
+                        try:
+                            from datetime import datetime, timezone
+                            delay = (parsedate_to_datetime(header)
+                                     - datetime.now(timezone.utc)).total_seconds()
+                            retry_after = max(delay, 0.0)
+                        except (TypeError, ValueError):
+                            pass
+                time.sleep(retry_after)
+                continue
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            if remaining is not None:
+                try:
+                    self._bucket.sync(int(float(remaining)))
+                except ValueError:
+                    pass
+            response.raise_for_status()
+            return response
+
+    def _make_request(self, messages: list[dict[str, str]], model: str = None) -> dict[str, Any]:
         """Make a request to the OpenRouter API."""
         if not self.api_key:
             print("Error: API key not set. Use 'nimbuscode config --api-key YOUR_API_KEY' or set the OPENROUTER_API_KEY environment variable.")
             sys.exit(1)
         
         if not model:
-            model = self.config["API"].get("default_model", DEFAULT_MODEL)
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com/naelmohammad/nimbuscode",
-            "X-Title": "NimbusCode"
-        }
-        
-        data = {
-            "model": model,
-            "messages": messages
-        }
+            model = self.config.get("default_model", DEFAULT_MODEL)
         
+        import requests
         try:
-            response = requests.post(API_URL, headers=headers, json=data)
-            response.raise_for_status()
-            return response.json()
+            response = self._post(self._request_data(messages, model))
+            return _json_loads(response.content)
         except requests.exceptions.RequestException as e:
             print(f"Error: Failed to communicate with OpenRouter API: {e}")
             sys.exit(1)
     
-    def ask(self, question: str, model: str = None) -> str:
+    def _cache_ttl(self) -> int:
+        """Return the cache TTL in seconds from config, or the default."""
+        return int(self.config.get("cache_ttl", DEFAULT_CACHE_TTL))
+
+    def _cache_key(self, messages: list[dict[str, str]], model: str) -> str:
+        """Compute a content-addressed cache key for a (model, messages) pair."""
+        payload = json.dumps(messages, sort_keys=True).encode() + model.encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    def _cache_get(self, key: str) -> str | None:
+        """Return a cached response if present and fresh, otherwise None."""
+        cache_file = CACHE_DIR / key
+        if not cache_file.exists():
+            return None
+        try:
+            entry = _json_loads(cache_file.read_bytes())
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["ts"] > self._cache_ttl():
+            return None
+        return entry["content"]
+
+    def _cache_put(self, key: str, content: str) -> None:
+        """Store a response in the on-disk cache."""
+        try:
+            _ensure_cache_dir()
+            (CACHE_DIR / key).write_bytes(_json_dumps({"ts": time.time(), "content": content}))
+        except OSError:
+            pass
+
+    def _evict_stale_cache(self) -> None:
+        """Remove cache entries older than the TTL in a single directory sweep."""
+        if not CACHE_DIR.exists():
+            return
+        cutoff = time.time() - self._cache_ttl()
+        try:
+            for entry in os.scandir(CACHE_DIR):
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+        except OSError:
+            pass
+
+    def _complete(self, messages: list[dict[str, str]], model: str = None, on_chunk=None) -> str:
+        """Return the completion for messages, consulting the on-disk cache first.
+
+        When on_chunk is given the response is streamed and each content
+        delta is passed to it as it arrives.
+        """
+        if not model:
+            model = self.config.get("default_model", DEFAULT_MODEL)
+        # Only refuse overlong prompts against an explicitly configured
+        # context_limit; a built-in default would wrongly reject prompts
+        # that large-context models accept, based on a rough estimate.
+        limit = self.config.get("context_limit")
+        if limit is not None:
+            limit = int(limit)
+            estimated = _estimate_tokens(messages)
+            if estimated > limit - RESPONSE_TOKEN_MARGIN:
+                print(f"Error: Prompt is an estimated {estimated} tokens, over the {limit - RESPONSE_TOKEN_MARGIN} available (context_limit {limit}). Trim the input or raise context_limit in the config.")
+                sys.exit(1)
+        key = self._cache_key(messages, model)
+        if self.use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                if on_chunk:
+                    on_chunk(cached)
+                return cached
+        if on_chunk:
+            chunks = []
+            for delta in self._stream_request(messages, model):
+                on_chunk(delta)
+                chunks.append(delta)
+            content = "".join(chunks)
+        else:
+            response = self._make_request(messages, model)
+            content = response["choices"][0]["message"]["content"]
+        if self.use_cache:
+            self._cache_put(key, content)
+        return content
+
+    def _complete_many(self, messages_list: list[list[dict[str, str]]], model: str = None) -> list[str]:
+        """Run several completions concurrently over the shared session."""
+        if len(messages_list) == 1:
+            return [self._complete(messages_list[0], model)]
+        from concurrent.futures import ThreadPoolExecutor
+        max_workers = min(MAX_CONCURRENT_REQUESTS, len(messages_list))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda messages: self._complete(messages, model), messages_list))
+
+    def _stream_request(self, messages: list[dict[str, str]], model: str = None):
+        """Stream a chat completion from the OpenRouter API, yielding content chunks."""
+        if not self.api_key:
+            print("Error: API key not set. Use 'nimbuscode config --api-key YOUR_API_KEY' or set the OPENROUTER_API_KEY environment variable.")
+            sys.exit(1)
+
+        if not model:
+            model = self.config.get("default_model", DEFAULT_MODEL)
+
+        import requests
+        try:
+            response = self._post(self._request_data(messages, model, stream=True), stream=True)
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                payload = line[6:]
+                if payload == "[DONE]":
+                    break
+                chunk = _json_loads(payload)
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+        except requests.exceptions.RequestException as e:
+            print(f"Error: Failed to communicate with OpenRouter API: {e}")
+            sys.exit(1)
+
+    def ask(self, question: str, model: str = None, on_chunk=None) -> str:
         """Ask a coding question."""
         messages = [
-            {"role": "system", "content": "You are a helpful coding assistant. Provide concise, accurate answers to coding questions."},
+            _SYS_ASK,
             {"role": "user", "content": question}
         ]
         
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
+        return self._complete(messages, model, on_chunk)
     
-    def generate(self, description: str, language: str = None, model: str = None) -> str:
-        """Generate code based on a description."""
-        content = f"Generate code for: {description}"
-        if language:
-            content += f"\nLanguage: {language}"
-        
+    def ask_race(self, question: str, models: list[str] = None) -> str:
+        """Ask the same question of several models and return the first answer.
+
+        The losing requests keep running in the pool but their results are
+        discarded; all entrants share the session's keep-alive connections.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
         messages = [
-            {"role": "system", "content": "You are a code generator. Create clean, efficient, and well-documented code based on descriptions."},
+            _SYS_ASK,
+            {"role": "user", "content": question}
+        ]
+        models = models or RACE_MODELS
+
+        executor = ThreadPoolExecutor(max_workers=len(models))
+        futures = {executor.submit(self._complete, messages, m) for m in models}
+        try:
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        print("Error: All raced models failed.")
+        sys.exit(1)
+
+    def _generate_messages(self, description: str, language: str = None) -> list[dict[str, str]]:
+        """Build the messages list for a generate request."""
+        content = "Generate code for: " + description + (f"\nLanguage: {language}" if language else "")
+
+        return [
+            _SYS_GENERATE,
             {"role": "user", "content": content}
         ]
-        
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
-    
-    def improve(self, code: str, model: str = None) -> str:
-        """Improve existing code."""
-        messages = [
-            {"role": "system", "content": "You are a code reviewer. Suggest improvements to make the code more efficient, readable, and maintainable."},
+
+    def generate(self, description: str, language: str = None, model: str = None) -> str:
+        """Generate code based on a description."""
+        return self._complete(self._generate_messages(description, language), model)
+
+    def generate_many(self, descriptions: list[str], language: str = None, model: str = None) -> list[str]:
+        """Generate code for several descriptions concurrently."""
+        return self._complete_many([self._generate_messages(d, language) for d in descriptions], model)
+
+    def _improve_messages(self, code: str) -> list[dict[str, str]]:
+        """Build the messages list for an improve request."""
+        return [
+            _SYS_IMPROVE,
             {"role": "user", "content": f"Improve this code:\n\n```\n{code}\n```"}
         ]
-        
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
-    
-    def explain(self, code: str, model: str = None) -> str:
-        """Explain code."""
-        messages = [
-            {"role": "system", "content": "You are a code explainer. Break down complex code into understandable explanations."},
+
+    def improve(self, code: str, model: str = None) -> str:
+        """Improve existing code."""
+        return self._complete(self._improve_messages(code), model)
+
+    def improve_many(self, codes: list[str], model: str = None) -> list[str]:
+        """Improve several pieces of code concurrently."""
+        return self._complete_many([self._improve_messages(code) for code in codes], model)
+    
+    def _explain_messages(self, code: str) -> list[dict[str, str]]:
+        """Build the messages list for an explain request."""
+        return [
+            _SYS_EXPLAIN,
             {"role": "user", "content": f"Explain this code:\n\n```\n{code}\n```"}
         ]
-        
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
+
+    def explain(self, code: str, model: str = None, on_chunk=None) -> str:
+        """Explain code."""
+        return self._complete(self._explain_messages(code), model, on_chunk)
     
-    def cloud(self, description: str, provider: str = "aws", model: str = None) -> str:
+    def cloud(self, description: str, provider: str = "aws", model: str = None, on_chunk=None) -> str:
         """Generate cloud deployment guidance."""
         messages = [
-            {"role": "system", "content": "You are a cloud deployment expert. Provide clear instructions for deploying applications to cloud platforms."},
+            _SYS_CLOUD,
             {"role": "user", "content": f"Provide deployment instructions for {provider} for: {description}"}
         ]
         
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
+        return self._complete(messages, model, on_chunk)
     
-    def mobile(self, description: str, platform: str = "cross", model: str = None) -> str:
+    def mobile(self, description: str, platform: str = "cross", model: str = None, on_chunk=None) -> str:
         """Generate mobile development guidance."""
         messages = [
-            {"role": "system", "content": "You are a mobile development expert. Provide guidance for building mobile applications."},
+            _SYS_MOBILE,
             {"role": "user", "content": f"Provide {platform} platform mobile development guidance for: {description}"}
         ]
         
-        response = self._make_request(messages, model)
-        return response["choices"][0]["message"]["content"]
+        return self._complete(messages, model, on_chunk)
     
     def interactive(self, model: str = None) -> None:
         """Start an interactive session."""
@@ -153,9 +590,10 @@ class NimbusCode:
         print("------------------------------------------------")
         
         messages = [
-            {"role": "system", "content": "You are a helpful coding assistant. Provide concise, accurate answers to coding questions."}
+            _SYS_ASK
         ]
-        
+        keep_turns = int(self.config.get("history_turns", DEFAULT_HISTORY_TURNS))
+
         while True:
             try:
                 user_input = input("\n> ")
@@ -163,105 +601,241 @@ class NimbusCode:
                     break
                 
                 messages.append({"role": "user", "content": user_input})
-                response = self._make_request(messages, model)
-                assistant_response = response["choices"][0]["message"]["content"]
-                
-                print("\n" + assistant_response)
-                messages.append({"role": "assistant", "content": assistant_response})
+                # Move the prompt-cache breakpoint to the end of the stable
+                # prefix so multi-turn sessions reuse the provider-side cache.
+                for msg in messages[1:-2]:
+                    if isinstance(msg["content"], list):
+                        msg["content"][0].pop("cache_control", None)
+                if len(messages) > 2 and isinstance(messages[-2]["content"], str):
+                    messages[-2]["content"] = _cacheable(messages[-2]["content"])
+                print()
+                chunks = []
+                for delta in self._stream_request(messages, model):
+                    print(delta, end="", flush=True)
+                    chunks.append(delta)
+                print()
+                messages.append({"role": "assistant", "content": "".join(chunks)})
+                # Keep the system prompt plus the last keep_turns exchanges so
+                # per-turn encode and token cost stay bounded in long sessions.
+                if len(messages) > 2 * keep_turns + 1:
+                    messages[1:] = messages[-2 * keep_turns:]
                 
             except KeyboardInterrupt:
                 print("\nExiting interactive mode.")
                 break
     
+    def _iter_free_models(self, response):
+        """Yield free models from a catalog response.
+
+        With ijson installed the body is parsed incrementally so only one
+        catalog entry is materialized at a time; otherwise the full body
+        is decoded in one pass.
+        """
+        try:
+            import ijson
+        except ImportError:
+            for model in _json_loads(response.content)["data"]:
+                if _is_free_model(model):
+                    yield model
+            return
+        response.raw.decode_content = True
+        for model in ijson.items(response.raw, "data.item", use_float=True):
+            if _is_free_model(model):
+                yield model
+
     def list_models(self) -> None:
         """List available free models from OpenRouter."""
         if not self.api_key:
             print("Error: API key not set. Use 'nimbuscode config --api-key YOUR_API_KEY' or set the OPENROUTER_API_KEY environment variable.")
             sys.exit(1)
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
+        import requests
         try:
-            response = requests.get("https://openrouter.ai/api/v1/models", headers=headers)
-            response.raise_for_status()
-            models = response.json()["data"]
-            
+            headers = self._base_headers
+            if MODELS_ETAG_FILE.exists() and MODELS_CACHE_FILE.exists():
+                headers = {**self._base_headers, "If-None-Match": MODELS_ETAG_FILE.read_text().strip()}
+
+            response = self.session.get(MODELS_URL, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304:
+                source = _json_loads(MODELS_CACHE_FILE.read_bytes())
+                fresh = False
+            else:
+                response.raise_for_status()
+                source = self._iter_free_models(response)
+                fresh = True
+
             print("Available Free Models:")
             print("---------------------")
-            
-            free_models = [model for model in models if model.get("pricing", {}).get("prompt") == 0 and model.get("pricing", {}).get("completion") == 0]
-            
-            if not free_models:
-                print("No free models available.")
-                return
-            
-            for model in free_models:
+
+            # Print while filtering so the catalog is walked once; the
+            # list only accumulates the free subset for the ETag cache.
+            free_models = []
+            for model in source:
+                free_models.append(model)
                 print(f"ID: {model['id']}")
                 print(f"Name: {model['name']}")
                 print(f"Context Length: {model.get('context_length', 'Unknown')}")
                 print("---------------------")
-            
+
+            if not free_models:
+                print("No free models available.")
+                return
+
+            if fresh:
+                try:
+                    _ensure_config_dir()
+                    MODELS_CACHE_FILE.write_bytes(_json_dumps(free_models))
+                    if "ETag" in response.headers:
+                        MODELS_ETAG_FILE.write_text(response.headers["ETag"])
+                except OSError:
+                    pass
+
         except requests.exceptions.RequestException as e:
             print(f"Error: Failed to fetch models: {e}")
             sys.exit(1)
 
+class _StreamPrinter:
+    """Print streamed chunks to stdout, word-wrapped to a fixed width."""
+
+    def __init__(self, width: int = 80):
+        self.width = width
+        self.column = 0
+        self.word = ""
+
+    def write(self, chunk: str) -> None:
+        for char in chunk:
+            if char == "\n":
+                self._flush_word()
+                sys.stdout.write("\n")
+                self.column = 0
+            elif char.isspace():
+                self._flush_word()
+                if self.column and self.column < self.width:
+                    sys.stdout.write(char)
+                    self.column += 1
+            else:
+                self.word += char
+        sys.stdout.flush()
+
+    def _flush_word(self) -> None:
+        if not self.word:
+            return
+        if self.column and self.column + len(self.word) >= self.width:
+            sys.stdout.write("\n")
+            self.column = 0
+        sys.stdout.write(self.word)
+        self.column += len(self.word)
+        self.word = ""
+
+    def close(self) -> None:
+        self._flush_word()
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
 def main():
-    nimbus = NimbusCode()
-    
+    import argparse
+
     parser = argparse.ArgumentParser(description="NimbusCode - A lightweight AI coding assistant")
     subparsers = parser.add_subparsers(dest="command", help="Command to execute")
     
-    # Config command
-    config_parser = subparsers.add_parser("config", help="Configure NimbusCode")
-    config_parser.add_argument("--api-key", help="Set OpenRouter API key")
-    
-    # Ask command
-    ask_parser = subparsers.add_parser("ask", help="Ask a coding question")
-    ask_parser.add_argument("question", help="The question to ask")
-    ask_parser.add_argument("--model", help="Specify the model to use")
-    
-    # Generate command
-    generate_parser = subparsers.add_parser("generate", help="Generate code")
-    generate_parser.add_argument("description", help="Description of the code to generate")
-    generate_parser.add_argument("--language", help="Programming language")
-    generate_parser.add_argument("--model", help="Specify the model to use")
-    generate_parser.add_argument("--save", help="Save output to file")
-    
-    # Improve command
-    improve_parser = subparsers.add_parser("improve", help="Improve existing code")
-    improve_parser.add_argument("file", help="File containing code to improve")
-    improve_parser.add_argument("--model", help="Specify the model to use")
-    improve_parser.add_argument("--save", help="Save output to file")
-    
-    # Explain command
-    explain_parser = subparsers.add_parser("explain", help="Explain code")
-    explain_parser.add_argument("file", help="File containing code to explain")
-    explain_parser.add_argument("--model", help="Specify the model to use")
-    
-    # Cloud command
-    cloud_parser = subparsers.add_parser("cloud", help="Get cloud deployment guidance")
-    cloud_parser.add_argument("description", help="Description of the deployment")
-    cloud_parser.add_argument("--provider", choices=["aws", "azure", "gcp"], default="aws", help="Cloud provider")
-    cloud_parser.add_argument("--model", help="Specify the model to use")
-    
-    # Mobile command
-    mobile_parser = subparsers.add_parser("mobile", help="Get mobile development guidance")
-    mobile_parser.add_argument("description", help="Description of the mobile app")
-    mobile_parser.add_argument("--platform", choices=["ios", "android", "cross"], default="cross", help="Mobile platform")
-    mobile_parser.add_argument("--model", help="Specify the model to use")
-    
-    # Interactive command
-    interactive_parser = subparsers.add_parser("interactive", help="Start interactive mode")
-    interactive_parser.add_argument("--model", help="Specify the model to use")
-    
-    # Models command
-    models_parser = subparsers.add_parser("models", help="List available free models")
-    
+    def _register_config():
+        config_parser = subparsers.add_parser("config", help="Configure NimbusCode")
+        config_parser.add_argument("--api-key", help="Set OpenRouter API key")
+        return config_parser
+
+    def _register_ask():
+        ask_parser = subparsers.add_parser("ask", help="Ask a coding question")
+        ask_parser.add_argument("question", help="The question to ask")
+        ask_parser.add_argument("--model", help="Specify the model to use")
+        ask_parser.add_argument("--race", action="store_true", help="Race several free models and print the first answer")
+        ask_parser.add_argument("--extract", action="store_true", help="Save code blocks from the answer to code_block_N.txt files")
+        ask_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        return ask_parser
+
+    def _register_generate():
+        generate_parser = subparsers.add_parser("generate", help="Generate code")
+        generate_parser.add_argument("description", nargs="?", help="Description of the code to generate")
+        generate_parser.add_argument("--batch", help="File containing one description per line")
+        generate_parser.add_argument("--language", help="Programming language")
+        generate_parser.add_argument("--model", help="Specify the model to use")
+        generate_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        generate_parser.add_argument("--save", help="Save output to file")
+        return generate_parser
+
+    def _register_improve():
+        improve_parser = subparsers.add_parser("improve", help="Improve existing code")
+        improve_parser.add_argument("file", nargs="?", help="File containing code to improve")
+        improve_parser.add_argument("--files", help="Glob pattern of files to improve concurrently")
+        improve_parser.add_argument("--model", help="Specify the model to use")
+        improve_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        improve_parser.add_argument("--dry-run", action="store_true", help="Estimate prompt tokens without sending a request")
+        improve_parser.add_argument("--save", help="Save output to file")
+        return improve_parser
+
+    def _register_explain():
+        explain_parser = subparsers.add_parser("explain", help="Explain code")
+        explain_parser.add_argument("file", help="File containing code to explain")
+        explain_parser.add_argument("--model", help="Specify the model to use")
+        explain_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        explain_parser.add_argument("--dry-run", action="store_true", help="Estimate prompt tokens without sending a request")
+        return explain_parser
+
+    def _register_cloud():
+        cloud_parser = subparsers.add_parser("cloud", help="Get cloud deployment guidance")
+        cloud_parser.add_argument("description", help="Description of the deployment")
+        cloud_parser.add_argument("--provider", choices=["aws", "azure", "gcp"], default="aws", help="Cloud provider")
+        cloud_parser.add_argument("--model", help="Specify the model to use")
+        cloud_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        return cloud_parser
+
+    def _register_mobile():
+        mobile_parser = subparsers.add_parser("mobile", help="Get mobile development guidance")
+        mobile_parser.add_argument("description", help="Description of the mobile app")
+        mobile_parser.add_argument("--platform", choices=["ios", "android", "cross"], default="cross", help="Mobile platform")
+        mobile_parser.add_argument("--model", help="Specify the model to use")
+        mobile_parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+        return mobile_parser
+
+    def _register_interactive():
+        interactive_parser = subparsers.add_parser("interactive", help="Start interactive mode")
+        interactive_parser.add_argument("--model", help="Specify the model to use")
+        return interactive_parser
+
+    def _register_models():
+        return subparsers.add_parser("models", help="List available free models")
+
+    registrars = {
+        "config": _register_config,
+        "ask": _register_ask,
+        "generate": _register_generate,
+        "improve": _register_improve,
+        "explain": _register_explain,
+        "cloud": _register_cloud,
+        "mobile": _register_mobile,
+        "interactive": _register_interactive,
+        "models": _register_models,
+    }
+
+    # Register only the invoked subcommand's parser; anything else (no
+    # command, --help, typos) registers all of them so help stays complete.
+    sniffed = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith("-") else None
+    if sniffed in registrars:
+        command_parsers = {sniffed: registrars[sniffed]()}
+    else:
+        command_parsers = {name: register() for name, register in registrars.items()}
+
     args = parser.parse_args()
-    
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    # Constructing NimbusCode reads config and touches the cache directory,
+    # so defer it until a command actually runs.
+    nimbus = NimbusCode()
+    if getattr(args, "no_cache", False):
+        nimbus.use_cache = False
+
     if args.command == "config":
         if args.api_key:
             nimbus.set_api_key(args.api_key)
@@ -269,51 +843,104 @@ def main():
             parser.print_help()
     
     elif args.command == "ask":
-        response = nimbus.ask(args.question, args.model)
-        print(textwrap.fill(response, width=80))
+        printer = _StreamPrinter()
+        if args.race:
+            race_models = None
+            if args.model:
+                # Race the requested model alongside the usual entrants.
+                race_models = [args.model] + [m for m in RACE_MODELS if m != args.model]
+            answer = nimbus.ask_race(args.question, race_models)
+            printer.write(answer)
+        else:
+            answer = nimbus.ask(args.question, args.model, on_chunk=printer.write)
+        printer.close()
+        if args.extract:
+            saved = _write_code_blocks(extract_code_blocks(answer))
+            for path in saved:
+                print(f"Code block saved to {path}")
+            if not saved:
+                print("No code blocks found in the answer")
     
     elif args.command == "generate":
-        response = nimbus.generate(args.description, args.language, args.model)
-        if args.save:
-            with open(args.save, "w") as f:
-                f.write(response)
-            print(f"Code saved to {args.save}")
+        if args.batch:
+            with open(args.batch, "r") as f:
+                descriptions = [line.strip() for line in f if line.strip()]
+            if not descriptions:
+                print(f"Error: No descriptions found in {args.batch}")
+                sys.exit(1)
+            responses = nimbus.generate_many(descriptions, args.language, args.model)
+            for description, response in zip(descriptions, responses):
+                print(f"=== {description} ===")
+                print(response)
+                print()
+        elif args.description:
+            response = nimbus.generate(args.description, args.language, args.model)
+            if args.save:
+                with open(args.save, "w") as f:
+                    f.write(response)
+                print(f"Code saved to {args.save}")
+            else:
+                print(response)
         else:
-            print(response)
-    
+            command_parsers["generate"].error("a description or --batch is required")
+
     elif args.command == "improve":
-        with open(args.file, "r") as f:
-            code = f.read()
-        response = nimbus.improve(code, args.model)
-        if args.save:
-            with open(args.save, "w") as f:
-                f.write(response)
-            print(f"Improved code saved to {args.save}")
+        if args.files:
+            import glob
+            paths = sorted(glob.glob(args.files, recursive=True))
+            if not paths:
+                print(f"Error: No files match {args.files}")
+                sys.exit(1)
+            codes = [_read_source(path) for path in paths]
+            if args.dry_run:
+                for path, code in zip(paths, codes):
+                    print(f"{path}: ~{_estimate_tokens(nimbus._improve_messages(code))} prompt tokens")
+                return
+            responses = nimbus.improve_many(codes, args.model)
+            for path, response in zip(paths, responses):
+                out_path = f"{path}.improved.md"
+                with open(out_path, "w") as f:
+                    f.write(response)
+                print(f"Improved code saved to {out_path}")
+        elif args.file:
+            code = _read_source(args.file)
+            if args.dry_run:
+                print(f"~{_estimate_tokens(nimbus._improve_messages(code))} prompt tokens")
+                return
+            response = nimbus.improve(code, args.model)
+            if args.save:
+                with open(args.save, "w") as f:
+                    f.write(response)
+                print(f"Improved code saved to {args.save}")
+            else:
+                print(response)
         else:
-            print(response)
+            command_parsers["improve"].error("a file or --files is required")
     
     elif args.command == "explain":
-        with open(args.file, "r") as f:
-            code = f.read()
-        response = nimbus.explain(code, args.model)
-        print(textwrap.fill(response, width=80))
+        code = _read_source(args.file)
+        if args.dry_run:
+            print(f"~{_estimate_tokens(nimbus._explain_messages(code))} prompt tokens")
+            return
+        printer = _StreamPrinter()
+        nimbus.explain(code, args.model, on_chunk=printer.write)
+        printer.close()
     
     elif args.command == "cloud":
-        response = nimbus.cloud(args.description, args.provider, args.model)
-        print(textwrap.fill(response, width=80))
+        printer = _StreamPrinter()
+        nimbus.cloud(args.description, args.provider, args.model, on_chunk=printer.write)
+        printer.close()
     
     elif args.command == "mobile":
-        response = nimbus.mobile(args.description, args.platform, args.model)
-        print(textwrap.fill(response, width=80))
+        printer = _StreamPrinter()
+        nimbus.mobile(args.description, args.platform, args.model, on_chunk=printer.write)
+        printer.close()
     
     elif args.command == "interactive":
         nimbus.interactive(args.model)
     
     elif args.command == "models":
         nimbus.list_models()
-    
-    else:
-        parser.print_help()
 
 if __name__ == "__main__":
     main()
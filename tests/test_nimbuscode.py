@@ -6,6 +6,7 @@ Unit tests for NimbusCode Python implementation.
 import os
 import sys
 import json
+import shutil
 import unittest
 from unittest.mock import patch, MagicMock
 from pathlib import Path
@@ -19,85 +20,88 @@ class TestNimbusCode(unittest.TestCase):
 
     def setUp(self):
         """Set up test environment."""
-        # Create a temporary config directory and file for testing
+        # Point the module at a throwaway config directory
         self.test_config_dir = Path("./test_config")
-        self.test_config_file = self.test_config_dir / "config.json"
-        
-        # Override the config paths for testing
+        self.test_config_file = self.test_config_dir / "config.toml"
+
         nimbuscode.CONFIG_DIR = self.test_config_dir
         nimbuscode.CONFIG_FILE = self.test_config_file
-        
-        # Create the test directory
+        nimbuscode.LEGACY_CONFIG_FILE = self.test_config_dir / "config.ini"
+        nimbuscode.CACHE_DIR = self.test_config_dir / "cache"
+
         self.test_config_dir.mkdir(exist_ok=True)
-        
-        # Create a test config file
-        test_config = {
-            "api_key": "test_api_key",
-            "model": "test_model",
-            "max_tokens": 500,
-            "temperature": 0.5,
-        }
-        with open(self.test_config_file, "w") as f:
-            json.dump(test_config, f)
+        self.test_config_file.write_text(
+            'api_key = "test_api_key"\n'
+            'default_model = "test_model"\n'
+        )
+        nimbuscode._load_config_cached.cache_clear()
+        nimbuscode._config_dir_ready = False
+        nimbuscode._cache_dir_ready = False
 
     def tearDown(self):
         """Clean up after tests."""
-        # Remove the test config file and directory
-        if self.test_config_file.exists():
-            self.test_config_file.unlink()
+        nimbuscode._load_config_cached.cache_clear()
         if self.test_config_dir.exists():
-            self.test_config_dir.rmdir()
+            shutil.rmtree(self.test_config_dir)
+
+    def _make_nimbus(self):
+        """Build a NimbusCode instance that reads the test config."""
+        with patch.dict(os.environ, {"OPENROUTER_API_KEY": ""}):
+            return nimbuscode.NimbusCode()
 
     def test_load_config(self):
         """Test loading configuration from file."""
-        config = nimbuscode.load_config()
+        config = nimbuscode._load_config_cached()
         self.assertEqual(config["api_key"], "test_api_key")
-        self.assertEqual(config["model"], "test_model")
-        self.assertEqual(config["max_tokens"], 500)
-        self.assertEqual(config["temperature"], 0.5)
+        self.assertEqual(config["default_model"], "test_model")
+
+    def test_load_config_is_cached(self):
+        """Test that the parsed config is reused within a process."""
+        self.assertIs(nimbuscode._load_config_cached(), nimbuscode._load_config_cached())
 
     def test_save_config(self):
         """Test saving configuration to file."""
-        new_config = {
-            "api_key": "new_api_key",
-            "model": "new_model",
-            "max_tokens": 1000,
-            "temperature": 0.7,
-        }
-        nimbuscode.save_config(new_config)
-        
+        nimbus = self._make_nimbus()
+        nimbus.config["default_model"] = "new_model"
+        nimbus._save_config()
+
         # Load the config again to verify it was saved
-        loaded_config = nimbuscode.load_config()
-        self.assertEqual(loaded_config["api_key"], "new_api_key")
-        self.assertEqual(loaded_config["model"], "new_model")
-        self.assertEqual(loaded_config["max_tokens"], 1000)
-        self.assertEqual(loaded_config["temperature"], 0.7)
+        loaded = nimbuscode._load_config_cached()
+        self.assertEqual(loaded["api_key"], "test_api_key")
+        self.assertEqual(loaded["default_model"], "new_model")
+
+    def test_save_config_escapes_values(self):
+        """Test that saved values with quotes and booleans reload cleanly."""
+        nimbus = self._make_nimbus()
+        nimbus.config["api_key"] = 'key "with" quotes\\and backslash'
+        nimbus.config["use_cache"] = True
+        nimbus._save_config()
+
+        loaded = nimbuscode._load_config_cached()
+        self.assertEqual(loaded["api_key"], 'key "with" quotes\\and backslash')
+        self.assertIs(loaded["use_cache"], True)
 
     def test_get_api_key(self):
         """Test getting API key from config."""
-        with patch.dict(os.environ, {"OPENROUTER_API_KEY": ""}):
-            api_key = nimbuscode.get_api_key()
-            self.assertEqual(api_key, "test_api_key")
+        nimbus = self._make_nimbus()
+        self.assertEqual(nimbus.api_key, "test_api_key")
 
     def test_get_api_key_from_env(self):
         """Test getting API key from environment variable."""
-        # Remove the api_key from config
-        config = nimbuscode.load_config()
-        config["api_key"] = ""
-        nimbuscode.save_config(config)
-        
-        # Set environment variable
         with patch.dict(os.environ, {"OPENROUTER_API_KEY": "env_api_key"}):
-            api_key = nimbuscode.get_api_key()
-            self.assertEqual(api_key, "env_api_key")
+            nimbus = nimbuscode.NimbusCode()
+            self.assertEqual(nimbus.api_key, "env_api_key")
 
-    @patch('nimbuscode.requests.post')
-    def test_query_openrouter(self, mock_post):
+    def test_make_request(self):
         """Test querying the OpenRouter API."""
-        # Mock the response from requests.post
+        nimbus = self._make_nimbus()
+
+        # Mock the response from the session post
         mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.headers = {}
         mock_response.raise_for_status.return_value = None
-        mock_response.json.return_value = {
+        mock_response.content = json.dumps({
             "choices": [
                 {
                     "message": {
@@ -105,49 +109,67 @@ class TestNimbusCode(unittest.TestCase):
                     }
                 }
             ]
-        }
-        mock_post.return_value = mock_response
-        
-        # Call the function
-        response = nimbuscode.query_openrouter("Test prompt", "Test system prompt")
-        
+        }).encode("utf-8")
+
+        messages = [{"role": "user", "content": "Test prompt"}]
+        with patch.object(nimbus.session, "post", return_value=mock_response) as mock_post:
+            response = nimbus._make_request(messages, "test_model")
+
         # Verify the response
-        self.assertEqual(response, "Test response")
-        
+        self.assertEqual(response["choices"][0]["message"]["content"], "Test response")
+
         # Verify the API was called with the correct parameters
         mock_post.assert_called_once()
         args, kwargs = mock_post.call_args
-        self.assertEqual(args[0], "https://openrouter.ai/api/v1/chat/completions")
+        self.assertEqual(args[0], nimbuscode.API_URL)
         self.assertIn("headers", kwargs)
-        self.assertIn("json", kwargs)
-        self.assertEqual(kwargs["json"]["messages"][0]["role"], "system")
-        self.assertEqual(kwargs["json"]["messages"][0]["content"], "Test system prompt")
-        self.assertEqual(kwargs["json"]["messages"][1]["role"], "user")
-        self.assertEqual(kwargs["json"]["messages"][1]["content"], "Test prompt")
+        sent = json.loads(kwargs["data"])
+        self.assertEqual(sent["model"], "test_model")
+        self.assertEqual(sent["messages"][0]["role"], "user")
+        self.assertEqual(sent["messages"][0]["content"], "Test prompt")
+
+    def test_response_cache_roundtrip(self):
+        """Test that completions are served from the on-disk cache."""
+        nimbus = self._make_nimbus()
+        messages = [{"role": "user", "content": "Test prompt"}]
+        key = nimbus._cache_key(messages, "test_model")
+        nimbus._cache_put(key, "cached answer")
+        self.assertEqual(nimbus._complete(messages, "test_model"), "cached answer")
 
     def test_extract_code_blocks(self):
         """Test extracting code blocks from markdown text."""
         markdown_text = """
         Here is some code:
-        
+
         ```python
         def hello():
             print("Hello, world!")
         ```
-        
+
         And another block:
-        
+
         ```javascript
         function hello() {
             console.log("Hello, world!");
         }
         ```
         """
-        
+
         code_blocks = nimbuscode.extract_code_blocks(markdown_text)
         self.assertEqual(len(code_blocks), 2)
         self.assertEqual(code_blocks[0], '        def hello():\n            print("Hello, world!")')
         self.assertEqual(code_blocks[1], '        function hello() {\n            console.log("Hello, world!");\n        }')
 
+    def test_iter_code_blocks_streaming(self):
+        """Test extracting code blocks incrementally from streamed chunks."""
+        chunks = [
+            "Here is some code:\n``",
+            "`python\ndef hello():\n    pass\n",
+            "```\nAnd more:\n```js\nlet x",
+            " = 1;\n```\n",
+        ]
+        blocks = list(nimbuscode.iter_code_blocks(chunks))
+        self.assertEqual(blocks, ["def hello():\n    pass", "let x = 1;"])
+
 if __name__ == "__main__":
     unittest.main()